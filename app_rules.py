@@ -1,114 +1,163 @@
 import streamlit as st
 import pandas as pd
-import openpyxl
+import numpy as np
+import os
 from io import BytesIO
 
-st.set_page_config(page_title="Product Classifier", layout="wide")
-st.title("🧠 Product Classifier Tool for Flywheel")
-st.markdown("Upload your product details and rules to auto-classify using AI-style logic.")
-
-product_file = st.file_uploader("📦 Upload Product Details (Excel)", type=["xlsx"])
-rules_file = st.file_uploader("📋 Upload Classification Rules (Excel)", type=["xlsx"])
-
-def clean_or_split(text):
-    """Always splits by OR logic (used for Exclude)."""
-    if pd.isna(text) or not isinstance(text, str):
-        return []
-    text = text.replace(' and ', ',').replace(' or ', ',')
-    return [t.strip().lower() for t in text.split(',') if t.strip()]
-
-def parse_include(text):
-    """Splits Include text respecting AND and OR logic."""
-    if pd.isna(text) or not isinstance(text, str):
-        return []
-
-    text = text.lower()
-
-    if ' and ' in text:
-        and_parts = text.split(' and ')
-        return [clean_or_split(part) for part in and_parts]
-    else:
-        return [clean_or_split(text)]
-
-def preprocess_rules(rules_df):
-    parsed_rules = []
-    for _, row in rules_df.iterrows():
-        include = parse_include(row['Include'])
-        exclude = clean_or_split(row['Exclude'])
-        label = row['Rule']
-        parsed_rules.append((include, exclude, label))
-    return parsed_rules
-
-def matches_rule(title, include, exclude):
-    for and_block in include:
-        if not any(word in title for word in and_block):
-            return False
-    if any(word in title for word in exclude):
-        return False
-    return True
-
-def classify_products(product_df, parsed_rules):
+from classifier import (
+    CHUNK_SIZE,
+    PARALLEL_MIN_TITLES,
+    iter_chunk_results,
+    prepare_titles,
+    preprocess_rules,
+)
+
+def classify_products(product_df, compiled_rules):
     results = []
-    titles = product_df['TITLE'].str.lower().fillna('')
+    # Catalogs repeat titles a lot, so only distinct titles are classified.
+    codes, titles = pd.factorize(product_df['TITLE'].str.lower().fillna(''))
+    titles = prepare_titles(compiled_rules[0], np.asarray(titles, dtype=object))
     progress = st.progress(0)
 
-    for idx, title in enumerate(titles):
-        matches = []
-        for include, exclude, label in parsed_rules:
-            if matches_rule(title, include, exclude):
-                matches.append(label)
-        results.append(', '.join(matches))
-        if idx % 100 == 0 or idx == len(titles) - 1:
-            progress.progress((idx + 1) / len(titles))
-
-    product_df['mapped_classifications'] = results
+    parallel = len(titles) >= PARALLEL_MIN_TITLES
+    chunk_size = min(CHUNK_SIZE, -(-len(titles) // (os.cpu_count() or 1))) if parallel else CHUNK_SIZE
+    chunks = [titles[start:start + chunk_size] for start in range(0, len(titles), chunk_size)]
+
+    shown_percent = 0
+    for chunk_results in iter_chunk_results(chunks, compiled_rules, parallel):
+        results.extend(chunk_results)
+        # Each update is a websocket round-trip, so send at most one per percent.
+        percent = len(results) * 100 // len(titles)
+        if percent != shown_percent:
+            progress.progress(percent)
+            shown_percent = percent
+
+    # A worker that dies with StopIteration ends pool.imap early instead of raising.
+    if len(results) != len(titles):
+        raise RuntimeError(f"Classification stopped after {len(results)} of {len(titles)} titles.")
+    product_df['mapped_classifications'] = np.array(results, dtype=object)[codes]
     return product_df
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_excel(file_bytes, sheet_name=0):
+    """Reads an uploaded workbook, cached on its bytes so reruns skip parsing."""
+    return pd.read_excel(BytesIO(file_bytes), sheet_name=sheet_name, engine='calamine')
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def load_compiled_rules(file_bytes):
+    """Parses and compiles a rules workbook once per distinct upload.
+
+    A resource cache rather than a data cache: the compiled matcher can't be
+    pickled, and it is only ever read after compilation.
+    """
+    return preprocess_rules(load_excel(file_bytes, sheet_name=0))
+
 def create_excel_download(df, filename="output.xlsx", sheet_name="Sheet1"):
     output = BytesIO()
     try:
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             df.to_excel(writer, index=False, sheet_name=sheet_name)
-        output.seek(0)
-        return output.read()
+        return output.getvalue()
     except Exception as e:
         st.error(f"Error creating Excel file: {e}")
         return None
 
-if product_file and rules_file:
+def to_arrow_compatible(df):
+    """Casts mixed-type object columns (e.g. partly numeric SKUs) to str for pyarrow."""
+    mixed = [
+        col for col in df.columns
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed')
+    ]
+    if not mixed:
+        return df
+    df = df.copy()
+    for col in mixed:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def create_parquet_download(df):
+    output = BytesIO()
     try:
-        product_df = pd.read_excel(product_file, sheet_name=0, engine='openpyxl')  # dynamic: first sheet
-        rules_df = pd.read_excel(rules_file, sheet_name=0, engine='openpyxl')      # dynamic: first sheet
+        to_arrow_compatible(df).to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+        return output.getvalue()
+    except Exception as e:
+        st.error(f"Error creating Parquet file: {e}")
+        return None
 
-        if "TITLE" not in product_df.columns:
-            st.error("Product file must contain a 'TITLE' column.")
-            st.stop()
-        if not all(col in rules_df.columns for col in ['Rule', 'Include', 'Exclude']):
-            st.error("Rules file must contain 'Rule', 'Include', and 'Exclude' columns.")
+def create_feather_download(df):
+    output = BytesIO()
+    try:
+        to_arrow_compatible(df).to_feather(output, compression='zstd')
+        return output.getvalue()
+    except Exception as e:
+        st.error(f"Error creating Feather file: {e}")
+        return None
+
+def main():
+    st.set_page_config(page_title="Product Classifier", layout="wide")
+    st.title("🧠 Product Classifier Tool for Flywheel")
+    st.markdown("Upload your product details and rules to auto-classify using AI-style logic.")
+
+    product_file = st.file_uploader("📦 Upload Product Details (Excel)", type=["xlsx"])
+    rules_file = st.file_uploader("📋 Upload Classification Rules (Excel)", type=["xlsx"])
+
+    if product_file and rules_file:
+        try:
+            product_df = load_excel(product_file.getvalue(), sheet_name=0)  # dynamic: first sheet
+            rules_df = load_excel(rules_file.getvalue(), sheet_name=0)      # dynamic: first sheet
+
+            if "TITLE" not in product_df.columns:
+                st.error("Product file must contain a 'TITLE' column.")
+                st.stop()
+            if not all(col in rules_df.columns for col in ['Rule', 'Include', 'Exclude']):
+                st.error("Rules file must contain 'Rule', 'Include', and 'Exclude' columns.")
+                st.stop()
+
+        except Exception as e:
+            st.error(f"Error reading Excel files: {e}")
             st.stop()
 
-    except Exception as e:
-        st.error(f"Error reading Excel files: {e}")
-        st.stop()
-
-    st.success("✅ Files uploaded successfully!")
-
-    parsed_rules = preprocess_rules(rules_df)
-    output_df = classify_products(product_df, parsed_rules)
-
-    st.subheader("🔍 Preview of Classified Products")
-    st.dataframe(output_df, use_container_width=True)
-
-    csv = output_df.to_csv(index=False).encode('utf-8')
-    st.download_button("⬇️ Download Classified CSV", csv, "classified_products.csv", "text/csv")
-
-    excel_output = create_excel_download(output_df, "classified_products.xlsx", "Classified_Products")
-    if excel_output:
-        st.download_button(
-            label="⬇️ Download Classified Excel",
-            data=excel_output,
-            file_name="classified_products.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-elif product_file or rules_file:
-    st.warning("⚠️ Please upload both the Product and Rules files to proceed.")
+        st.success("✅ Files uploaded successfully!")
+
+        # Every widget interaction reruns the script; only classify again (and
+        # start a new worker pool) when a different file has been uploaded.
+        upload_key = (product_file.file_id, rules_file.file_id)
+        if st.session_state.get('classified_upload') != upload_key:
+            compiled_rules = load_compiled_rules(rules_file.getvalue())
+            st.session_state['classified_df'] = classify_products(product_df, compiled_rules)
+            st.session_state['classified_upload'] = upload_key
+        output_df = st.session_state['classified_df']
+
+        st.subheader("🔍 Preview of Classified Products")
+        st.dataframe(output_df, use_container_width=True)
+
+        # Only the chosen format is encoded, so nobody pays for XLSX unless they want it.
+        download_format = st.radio("📥 Download format", ["CSV", "Excel", "Parquet", "Feather"], horizontal=True)
+        if download_format == "CSV":
+            download_data = output_df.to_csv(index=False).encode('utf-8')
+            file_name, mime = "classified_products.csv", "text/csv"
+        elif download_format == "Excel":
+            download_data = create_excel_download(output_df, "classified_products.xlsx", "Classified_Products")
+            file_name, mime = "classified_products.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        elif download_format == "Parquet":
+            download_data = create_parquet_download(output_df)
+            file_name, mime = "classified_products.parquet", "application/vnd.apache.parquet"
+        else:
+            download_data = create_feather_download(output_df)
+            file_name, mime = "classified_products.feather", "application/vnd.apache.arrow.file"
+
+        if download_data:
+            st.download_button(
+                label=f"⬇️ Download Classified {download_format}",
+                data=download_data,
+                file_name=file_name,
+                mime=mime,
+                on_click="ignore"
+            )
+    elif product_file or rules_file:
+        st.warning("⚠️ Please upload both the Product and Rules files to proceed.")
+
+# Streamlit runs this script as __main__; pool workers started with
+# forkserver/spawn re-import it as __mp_main__ and must not build the UI.
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Rule parsing and title matching for the Product Classifier app.
+
+Kept free of Streamlit calls so Numba's kernel cache and pool workers can
+import it without running the UI.
+"""
+import pandas as pd
+import numpy as np
+import ahocorasick
+from numba import njit
+import re
+import multiprocessing
+
+try:
+    import hyperscan
+except ImportError:  # Hyperscan wheels are not published for every platform
+    hyperscan = None
+
+CHUNK_SIZE = 10_000  # titles per kernel call, bounds the match matrix to CHUNK_SIZE x rules
+PARALLEL_MIN_TITLES = 50_000  # below this, process start-up costs more than it saves
+
+def normalize_text(column):
+    """Lowercases a whole rules column at once; empty or non-text cells become None."""
+    try:
+        lowered = column.astype(object).str.lower()
+    except AttributeError:  # no text cells at all, e.g. an all-numeric column
+        return np.full(len(column), None, dtype=object)
+    return lowered.where(lowered.notna(), None).to_numpy()
+
+def clean_or_split(text):
+    """Always splits by OR logic (used for Exclude)."""
+    if text is None:
+        return []
+    text = text.replace(' and ', ',').replace(' or ', ',')
+    return [t.strip() for t in text.split(',') if t.strip()]
+
+def parse_include(text):
+    """Splits Include text respecting AND and OR logic."""
+    if text is None:
+        return []
+
+    if ' and ' in text:
+        and_parts = text.split(' and ')
+        return [clean_or_split(part) for part in and_parts]
+    else:
+        return [clean_or_split(text)]
+
+def build_matcher(token_ids):
+    """Compiles all tokens into one multi-pattern matcher.
+
+    Uses Hyperscan's compiled DFA when it is installed and falls back to an
+    Aho-Corasick automaton otherwise. Returns None when there are no tokens.
+    """
+    if not token_ids:
+        return None
+    if hyperscan is not None:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[re.escape(word.encode('utf-8')) for word in token_ids],
+            ids=list(token_ids.values()),
+            elements=len(token_ids),
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(token_ids),
+        )
+        return db
+    automaton = ahocorasick.Automaton()
+    for word, token_id in token_ids.items():
+        automaton.add_word(word, token_id)
+    automaton.make_automaton()
+    return automaton
+
+def preprocess_rules(rules_df):
+    """Parses rules and compiles every token into one multi-pattern matcher.
+
+    Tokens and OR-blocks are both interned to small int ids, so a token or
+    block shared by many rules is only evaluated once per title. Each rule
+    becomes a sorted tuple of distinct include block ids (AND of ORs) and
+    one exclude block id.
+    """
+    token_ids = {}
+    block_ids = {}
+
+    def intern_block(words):
+        block = frozenset(token_ids.setdefault(w, len(token_ids)) for w in words)
+        return block_ids.setdefault(block, len(block_ids))
+
+    includes = normalize_text(rules_df['Include'])
+    excludes = normalize_text(rules_df['Exclude'])
+    parsed_rules = []
+    for include_text, exclude_text, label in zip(includes, excludes, rules_df['Rule'].to_numpy()):
+        include = tuple(sorted({intern_block(block) for block in parse_include(include_text)}))
+        exclude = intern_block(clean_or_split(exclude_text))
+        parsed_rules.append((include, exclude, label))
+
+    labels = np.array([label for _, _, label in parsed_rules], dtype=object)
+    return build_matcher(token_ids), encode_rules(len(token_ids), list(block_ids), parsed_rules), labels
+
+def encode_rules(token_count, blocks, parsed_rules):
+    """Flattens blocks and rules into int32 arrays with offsets for match_all.
+
+    Also builds an inverted index from each token to the rules whose
+    smallest include block contains it; a title can only match a rule if it
+    hits one of those tokens. Rules without include blocks are always
+    candidates, and rules with an empty block can never match.
+    """
+    block_tokens = np.array([t for block in blocks for t in sorted(block)], dtype=np.int32)
+    block_off = np.cumsum([0] + [len(block) for block in blocks], dtype=np.int32)
+    rule_blocks = np.array([b for include, _, _ in parsed_rules for b in include], dtype=np.int32)
+    rule_off = np.cumsum([0] + [len(include) for include, _, _ in parsed_rules], dtype=np.int32)
+    rule_exclude = np.array([exclude for _, exclude, _ in parsed_rules], dtype=np.int32)
+
+    postings = [[] for _ in range(token_count)]
+    always_rules = []
+    for rule_idx, (include, _, _) in enumerate(parsed_rules):
+        if not include:
+            always_rules.append(rule_idx)
+            continue
+        for token_id in min((blocks[b] for b in include), key=len):
+            postings[token_id].append(rule_idx)
+    posting_rules = np.array([r for rules in postings for r in rules], dtype=np.int32)
+    posting_off = np.cumsum([0] + [len(rules) for rules in postings], dtype=np.int32)
+
+    return (token_count, block_tokens, block_off, rule_blocks, rule_off, rule_exclude,
+            posting_rules, posting_off, np.array(always_rules, dtype=np.int32))
+
+def make_scanner(matcher):
+    """Returns a function giving the ids of every rule token found in a title.
+
+    Titles are str for the Aho-Corasick automaton and UTF-8 bytes for
+    Hyperscan. Each scanner gets its own Hyperscan scratch space because the
+    compiled rules are shared between Streamlit sessions and a scratch can't be.
+    """
+    if matcher is None:
+        return lambda title: set()
+    if isinstance(matcher, ahocorasick.Automaton):
+        return lambda title: {token_id for _, token_id in matcher.iter(title)}
+    scratch = hyperscan.Scratch(matcher)
+
+    def scan(title):
+        present = set()
+        matcher.scan(title, match_event_handler=lambda token_id, *_: present.add(token_id), scratch=scratch)
+        return present
+    return scan
+
+def encode_titles(matcher, titles):
+    """Returns the token ids found in each title as flat int32 arrays with offsets."""
+    scan = make_scanner(matcher)
+    present_ids = []
+    present_off = [0]
+    for title in titles:
+        present_ids.extend(scan(title))
+        present_off.append(len(present_ids))
+    return np.array(present_ids, dtype=np.int32), np.array(present_off, dtype=np.int32)
+
+@njit(cache=True)
+def _block_hit(b, t, present, block_tokens, block_off, block_stamp, block_hit):
+    """Whether title t hits OR-block b, computed at most once per title."""
+    if block_stamp[b] != t:
+        block_stamp[b] = t
+        block_hit[b] = False
+        for i in range(block_off[b], block_off[b + 1]):
+            if present[block_tokens[i]]:
+                block_hit[b] = True
+                break
+    return block_hit[b]
+
+@njit(cache=True)
+def _rule_matches(r, t, present, block_tokens, block_off, rule_blocks, rule_off, rule_exclude,
+                  block_stamp, block_hit):
+    for i in range(rule_off[r], rule_off[r + 1]):
+        if not _block_hit(rule_blocks[i], t, present, block_tokens, block_off, block_stamp, block_hit):
+            return False
+    return not _block_hit(rule_exclude[r], t, present, block_tokens, block_off, block_stamp, block_hit)
+
+@njit(cache=True)
+def match_all(present_ids, present_off, token_count, block_tokens, block_off, rule_blocks, rule_off,
+              rule_exclude, posting_rules, posting_off, always_rules):
+    """Returns a (titles, rules) boolean matrix of which rules match each title.
+
+    Only rules reachable from the title's hit tokens through the inverted
+    index (plus rules without include blocks) are evaluated.
+    """
+    n_titles = len(present_off) - 1
+    n_blocks = len(block_off) - 1
+    n_rules = len(rule_off) - 1
+    out = np.zeros((n_titles, n_rules), dtype=np.bool_)
+    present = np.zeros(token_count, dtype=np.bool_)
+    block_stamp = np.full(n_blocks, -1, dtype=np.int64)
+    block_hit = np.zeros(n_blocks, dtype=np.bool_)
+    rule_stamp = np.full(n_rules, -1, dtype=np.int64)
+
+    for t in range(n_titles):
+        for i in range(present_off[t], present_off[t + 1]):
+            present[present_ids[i]] = True
+        for r in always_rules:
+            out[t, r] = _rule_matches(r, t, present, block_tokens, block_off, rule_blocks, rule_off,
+                                      rule_exclude, block_stamp, block_hit)
+        for i in range(present_off[t], present_off[t + 1]):
+            token_id = present_ids[i]
+            for j in range(posting_off[token_id], posting_off[token_id + 1]):
+                r = posting_rules[j]
+                if rule_stamp[r] == t:
+                    continue
+                rule_stamp[r] = t
+                out[t, r] = _rule_matches(r, t, present, block_tokens, block_off, rule_blocks, rule_off,
+                                          rule_exclude, block_stamp, block_hit)
+        for i in range(present_off[t], present_off[t + 1]):
+            present[present_ids[i]] = False
+    return out
+
+def classify_chunk(titles, compiled_rules):
+    """Returns the comma-joined matching rule labels for each title."""
+    matcher, encoded_rules, labels = compiled_rules
+    matched = match_all(*encode_titles(matcher, titles), *encoded_rules)
+    # nonzero walks the matrix row-major, so each title's rules come out
+    # contiguous and in rule order; bounds marks where each title's run starts.
+    rows, rule_idx = np.nonzero(matched)
+    bounds = np.searchsorted(rows, np.arange(len(titles) + 1))
+    return [', '.join(labels[rule_idx[start:stop]]) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+_worker_rules = None
+
+def _pool_payload(compiled_rules):
+    """Compiled rules in picklable form; Hyperscan databases travel as bytes."""
+    matcher, encoded_rules, labels = compiled_rules
+    if matcher is not None and not isinstance(matcher, ahocorasick.Automaton):
+        matcher = hyperscan.dumpb(matcher)
+    return matcher, encoded_rules, labels
+
+def _init_worker(matcher, encoded_rules, labels):
+    global _worker_rules
+    if isinstance(matcher, bytes):
+        matcher = hyperscan.loadb(matcher, hyperscan.HS_MODE_BLOCK)
+    _worker_rules = matcher, encoded_rules, labels
+
+def _classify_chunk_in_worker(titles):
+    return classify_chunk(titles, _worker_rules)
+
+def iter_chunk_results(chunks, compiled_rules, parallel):
+    """Yields classify_chunk results in order, using a process pool if asked.
+
+    Workers come from a forkserver (or spawn where that is missing) rather
+    than a fork of the multi-threaded Streamlit server, which could copy a
+    lock held by another session thread. They import this module and get
+    the compiled rules through the pool initializer.
+    match_all stays single-threaded; the pool already spreads titles over cores.
+    """
+    if not parallel:
+        for chunk in chunks:
+            yield classify_chunk(chunk, compiled_rules)
+        return
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with context.Pool(initializer=_init_worker, initargs=_pool_payload(compiled_rules)) as pool:
+        yield from pool.imap(_classify_chunk_in_worker, chunks)
+
+def prepare_titles(matcher, titles):
+    """Returns titles as the matcher scans them: str, or UTF-8 bytes for Hyperscan.
+
+    Encoding happens once over all distinct titles rather than once per scan.
+    """
+    if matcher is None or isinstance(matcher, ahocorasick.Automaton):
+        return titles
+    return pd.Series(titles, dtype=object).str.encode('utf-8').to_numpy()